@@ -0,0 +1,35 @@
+import logging
+from orchestrator import (
+    CONFIG_ERROR, MONGO_CONN_STR, MONGO_DB_NAME,
+    HISTORICAL_COLLECTION, SUGGESTED_TRADES_COLLECTION, get_mongo_client,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+def ensure_indexes():
+    """
+    One-shot bootstrap: create the MongoDB indexes the Stage 2 Sell orchestrator relies on.
+    Run at deploy time by the ensure_indexes workflow, not before every orchestrator run
+    (create_index is a no-op if the index exists).
+    """
+    if CONFIG_ERROR:
+        logging.error(CONFIG_ERROR)
+        return
+
+    try:
+        db = get_mongo_client(MONGO_CONN_STR)[MONGO_DB_NAME]
+
+        # Unique index on symbol + trade_type (suggested trades are upserted on this key)
+        db[SUGGESTED_TRADES_COLLECTION].create_index([("symbol", 1), ("trade_type", 1)], unique=True)
+
+        # Compound index so the latest-row lookup is an index-backed top-1 scan
+        db[HISTORICAL_COLLECTION].create_index([("symbol", 1), ("timestamp", -1)])
+    except Exception as e:
+        logging.error(f"Error creating MongoDB indexes: {e}")
+        return
+
+    logging.info(f"Indexes ensured on {SUGGESTED_TRADES_COLLECTION} and {HISTORICAL_COLLECTION}")
+
+
+if __name__ == "__main__":
+    ensure_indexes()
@@ -1,173 +1,264 @@
 import logging
-import pandas as pd
+import numpy as np
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import PyMongoError
+from pymongo.server_api import ServerApi
 from dotenv import load_dotenv
-from sell_model import run as sell_model_run  # your Sell model logic
-from datetime import datetime
+from sell_model import predict_scores as sell_model_predict  # your Sell model logic
+from sell_model import load_model as sell_model_load
+from sell_model import BOUGHT_COLUMNS as MODEL_COLUMNS  # features the Sell model was trained on
+from operator import itemgetter
+from datetime import datetime, timezone
 from bson import ObjectId  # for proper buyid handling
 
 logging.basicConfig(level=logging.INFO)
 
-# Define the columns to pass to the model for bought and current row
-BOUGHT_COLUMNS = [
-    "open", "high", "low", "close", "volume", "quote_asset_volume",
-    "number_of_trades", "taker_buy_base", "taker_buy_quote", "macd",
-    "macd_signal", "macd_histogram", "rsi", "rsi_sma", "ema_100",
-    "ema_200", "atr", "relative_volume", "quote_volume_ratio",
-    "buy_sell_pressure", "ema_ratio", "rsi_x_relative_volume",
-    "macd_histogram_x_atr", "buy_sell_pressure_x_ema_ratio"
-]
+# Only the model features (plus row identity) are fetched from the historical collection
+_HIST_PROJ = {col: 1 for col in MODEL_COLUMNS}
+_HIST_PROJ.update({"_id": 1, "symbol": 1, "timestamp": 1})
 
-SELL_COLUMNS = [f"sell_{col}" for col in BOUGHT_COLUMNS]
+# Sell features start after the bought features in each feature row
+SELL_OFFSET = len(MODEL_COLUMNS)
+
+# Pulls the model feature values out of a historical row in one C-level call
+# (raises KeyError if the row lacks any of them)
+_get_model_features = itemgetter(*MODEL_COLUMNS)
+
+def _missing_model_features(bought_row, latest_row):
+    """
+    Return the model feature names (buy_/sell_ prefixed) absent from the bought or latest row.
+    """
+    return ([f"buy_{col}" for col in MODEL_COLUMNS if col not in bought_row] +
+            [f"sell_{col}" for col in MODEL_COLUMNS if col not in latest_row])
+
+# Initial feature rows allocated for active trades (the buffer doubles if more arrive)
+TRADE_ROWS_HINT = 64
 
 # Minimum sell score threshold
 MIN_SELL_SCORE = 0.7  # adjust as needed
 
+# MongoClient settings: a warm connection pool plus compressed wire traffic for the historical reads
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": 50,
+    "minPoolSize": 5,
+    "compressors": "zstd,snappy",
+    "serverSelectionTimeoutMS": 5000,
+    "socketTimeoutMS": 10000,
+    "server_api": ServerApi("1"),
+}
+
+# Connected clients keyed by connection string, reused across runs in the same process
+_CLIENT_CACHE = {}
+
+def get_mongo_client(connection_str):
+    """
+    Return the MongoClient for connection_str, creating it on first use.
+    """
+    client = _CLIENT_CACHE.get(connection_str)
+    if client is None:
+        client = MongoClient(connection_str, **MONGO_CLIENT_OPTIONS)
+        _CLIENT_CACHE[connection_str] = client
+    return client
+
+# -------------------------- Load environment variables (once, at import) --------------------------
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # SAME FOLDER AS SCRIPT
+DOTENV_PATH = os.path.join(BASE_DIR, ".env")            # .env RIGHT HERE
+DOTENV_FOUND = os.path.exists(DOTENV_PATH)
+if DOTENV_FOUND:
+    load_dotenv(DOTENV_PATH)
+
+# -------------------------- Inputs from environment --------------------------
+MONGO_CONN_STR = os.getenv("MONGO_CONN_STR")
+MONGO_DB_NAME = os.getenv("MONGO_DB_NAME")
+ACTIVE_TRADES_COLLECTION = os.getenv("ACTIVE_TRADES_TABLE")
+HISTORICAL_COLLECTION = os.getenv("MONGO_COLLECTION")
+SUGGESTED_TRADES_COLLECTION = os.getenv("SUGGESTED_TRADES_COLLECTION")
+SELL_MODEL_FILE = os.getenv("SELL_MODEL_FILE")  # file name from .env
+MODEL_FILE = os.path.join(BASE_DIR, SELL_MODEL_FILE) if SELL_MODEL_FILE else None
+
+def _config_error():
+    """
+    Return a description of the first configuration problem, or None if the config is usable.
+    """
+    if not DOTENV_FOUND:
+        return f".env file not found at {DOTENV_PATH}"
+    if not MONGO_CONN_STR or not MONGO_DB_NAME or not SELL_MODEL_FILE:
+        return "Missing required environment variables: MONGO_CONN_STR, MONGO_DB_NAME, or SELL_MODEL_FILE"
+    if not os.path.exists(MODEL_FILE):
+        return f"Sell model file not found at {MODEL_FILE}"
+    return None
+
+# Validated once; orchestrator_stage2_sell refuses to run while this is set
+CONFIG_ERROR = _config_error()
+
 def orchestrator_stage2_sell():
-    # -------------------------- Load environment variables --------------------------
-    base_dir = os.path.dirname(os.path.abspath(__file__))  # SAME FOLDER AS SCRIPT
-    dotenv_path = os.path.join(base_dir, ".env")            # .env RIGHT HERE
+    if CONFIG_ERROR:
+        logging.error(CONFIG_ERROR)
+        return
 
-    if not os.path.exists(dotenv_path):
-        logging.error(f".env file not found at {dotenv_path}")
+    # -------------------------- Connect to MongoDB --------------------------
+    try:
+        client = get_mongo_client(MONGO_CONN_STR)
+        db = client[MONGO_DB_NAME]
+        active_trades_col = db[ACTIVE_TRADES_COLLECTION]
+        suggested_trades_col = db[SUGGESTED_TRADES_COLLECTION]
+    except Exception as e:
+        logging.error(f"Error connecting to MongoDB: {e}")
         return
 
-    load_dotenv(dotenv_path)
+    # -------------------------- Fetch active trades with bought + latest rows --------------------------
+    # One round-trip: join each active trade to its bought row (by buyid) and to the
+    # latest row for its symbol. The latest-row join is a plain equality on symbol
+    # (like find({"symbol": ...})) followed directly by $sort -> $limit, so it is
+    # served by the (symbol, timestamp) index (see ensure_indexes.py) as a top-1 scan.
+    pipeline = [
+        {"$project": {
+            "_id": 0,
+            "symbol": 1,
+            "buyid": 1,
+            # buyid may be stored as a string; invalid values become null and match nothing
+            "buyid_obj": {"$convert": {"input": "$buyid", "to": "objectId", "onError": None, "onNull": None}},
+        }},
+        {"$lookup": {
+            "from": HISTORICAL_COLLECTION,
+            "localField": "buyid_obj",
+            "foreignField": "_id",
+            "pipeline": [{"$project": _HIST_PROJ}],
+            "as": "bought",
+        }},
+        {"$unwind": {"path": "$bought", "preserveNullAndEmptyArrays": True}},
+        {"$lookup": {
+            "from": HISTORICAL_COLLECTION,
+            "localField": "symbol",
+            "foreignField": "symbol",
+            "pipeline": [
+                {"$sort": {"timestamp": -1}},
+                {"$limit": 1},
+                {"$project": _HIST_PROJ},
+            ],
+            "as": "latest",
+        }},
+        {"$unwind": {"path": "$latest", "preserveNullAndEmptyArrays": True}},
+    ]
+
+    # One preallocated float32 row per trade: bought features, then latest (sell_) features
+    # (columns follow the model's feature order, see sell_model.EXPECTED_FEATURES)
+    X = np.full((TRADE_ROWS_HINT, 2 * len(MODEL_COLUMNS)), np.nan, dtype=np.float32)
+    symbols, buyids, sellids = [], [], []
+    found_trades = False
 
-    # -------------------------- Inputs from environment --------------------------
-    connection_str = os.getenv("MONGO_CONN_STR")
-    db_name = os.getenv("MONGO_DB_NAME")
-    active_trades_collection_name = os.getenv("ACTIVE_TRADES_TABLE")
-    historical_collection_name = os.getenv("MONGO_COLLECTION")
-    suggested_trades_collection_name = os.getenv("SUGGESTED_TRADES_COLLECTION")
-    model_file_name = os.getenv("SELL_MODEL_FILE")  # file name from .env
+    try:
+        # The client connects lazily, so this is the first call that reaches the server
+        trades = active_trades_col.aggregate(pipeline, batchSize=1000)
+
+        # -------------------------- Process each trade (streamed from the cursor) --------------------------
+        for trade in trades:
+            found_trades = True
+            symbol = trade['symbol']
+            buyid = trade.get('buyid')
+
+            if not buyid:
+                logging.warning(f"Trade for symbol {symbol} missing buyid. Skipping.")
+                continue
+
+            logging.info(f"Processing trade for symbol={symbol}, buyid={buyid}")
+
+            # Convert buyid to ObjectId (already-ObjectId values pass straight through)
+            if isinstance(buyid, ObjectId):
+                buyid_obj = buyid
+            elif ObjectId.is_valid(buyid):
+                buyid_obj = ObjectId(buyid)
+            else:
+                logging.warning(f"Invalid buyid format for {symbol}: {buyid}. Skipping trade.")
+                continue
+
+            # Row when we bought it
+            bought_row = trade.get("bought")
+            if not bought_row:
+                logging.warning(f"No bought row found for buyid {buyid}")
+                continue
+
+            # Latest/current row for this symbol
+            latest_row = trade.get("latest")
+            if not latest_row:
+                logging.warning(f"No latest row found for symbol {symbol}")
+                continue
+
+            # Fill this trade's row; null values become NaN, absent fields skip the trade
+            # (the model still scores all-NaN rows highly, so they must never reach it)
+            i = len(symbols)
+            if i == len(X):
+                X = np.vstack([X, np.full_like(X, np.nan)])  # out of rows: double the buffer
+            try:
+                X[i, :SELL_OFFSET] = _get_model_features(bought_row)
+                X[i, SELL_OFFSET:] = _get_model_features(latest_row)
+            except KeyError:
+                missing = _missing_model_features(bought_row, latest_row)
+                logging.warning(f"Missing model features for {symbol} (buyid {buyid}): {missing}. Skipping trade.")
+                continue
+            except (TypeError, ValueError) as e:
+                # Row i is reused by the next trade, so there is nothing to clean up
+                logging.warning(f"Non-numeric feature value for {symbol} (buyid {buyid}): {e}. Skipping trade.")
+                continue
+
+            symbols.append(symbol)
+            buyids.append(buyid_obj)  # store as ObjectId
+            sellids.append(latest_row["_id"])  # sellid is the latest row _id
+    except PyMongoError as e:
+        logging.error(f"Error fetching active trades from MongoDB: {e}")
+        return
 
-    if not connection_str or not db_name or not model_file_name:
-        logging.error("Missing required environment variables: MONGO_CONN_STR, MONGO_DB_NAME, or SELL_MODEL_FILE")
+    if not found_trades:
+        logging.info("No active trades found.")
         return
 
-    # -------------------------- Ensure model file path --------------------------
-    model_file = os.path.join(base_dir, model_file_name)
-    if not os.path.exists(model_file):
-        logging.error(f"Sell model file not found at {model_file}")
+    if not symbols:
+        logging.info("No active trades with both bought and latest rows. Nothing to predict.")
         return
 
-    # -------------------------- Connect to MongoDB --------------------------
+    # -------------------------- Run Sell model once for all trades --------------------------
     try:
-        client = MongoClient(connection_str)
-        db = client[db_name]
-        active_trades_col = db[active_trades_collection_name]
-        historical_col = db[historical_collection_name]
-        suggested_trades_col = db[suggested_trades_collection_name]
-
-        # Ensure unique index on symbol + trade_type
-        suggested_trades_col.create_index([("symbol", 1), ("trade_type", 1)], unique=True)
+        model = sell_model_load(MODEL_FILE)  # cached after the first run in this process
+        scores = sell_model_predict(X[:len(symbols)], model)
+        logging.info(f"Predictions generated for {len(symbols)} symbols")
     except Exception as e:
-        logging.error(f"Error connecting to MongoDB: {e}")
+        logging.error(f"Sell model prediction failed: {e}")
         return
 
-    # -------------------------- Fetch all active trades --------------------------
-    active_trades = list(active_trades_col.find({}, {"symbol": 1, "buyid": 1, "_id": 0}))
-    if not active_trades:
-        logging.info("No active trades found.")
+    # Filter by minimum sell_score
+    keep = np.flatnonzero(scores >= MIN_SELL_SCORE)
+    if keep.size == 0:
+        logging.info("No sell predictions above threshold. Skipping save.")
         return
 
-    # -------------------------- Process each trade --------------------------
-    for trade in active_trades:
-        symbol = trade['symbol']
-        buyid = trade.get('buyid')
-
-        if not buyid:
-            logging.warning(f"Trade for symbol {symbol} missing buyid. Skipping.")
-            continue
-
-        logging.info(f"Processing trade for symbol={symbol}, buyid={buyid}")
-
-        # Convert buyid to ObjectId
-        try:
-            buyid_obj = ObjectId(buyid)
-        except Exception as e:
-            logging.warning(f"Invalid buyid format for {symbol}: {buyid}. Skipping trade.")
-            continue
-
-        # Fetch the row when we bought it
-        df_bought = pd.DataFrame(list(historical_col.find({"_id": buyid_obj})))
-        if df_bought.empty:
-            logging.warning(f"No bought row found for buyid {buyid}")
-            continue
-
-        # Fetch the latest/current row for this symbol
-        latest_row_cursor = historical_col.find({"symbol": symbol}).sort("timestamp", -1).limit(1)
-        df_latest = pd.DataFrame(list(latest_row_cursor))
-        if df_latest.empty:
-            logging.warning(f"No latest row found for symbol {symbol}")
-            continue
-
-        # --- Extract sellid (latest row _id) ---
-        sellid = df_latest["_id"].iloc[0]
-
-        # Prefix latest columns with 'sell_'
-        df_latest_prefixed = df_latest.add_prefix('sell_')
-
-        # Filter columns to only expected for model
-        df_bought_filtered = df_bought[[col for col in BOUGHT_COLUMNS if col in df_bought.columns]]
-        df_latest_filtered = df_latest_prefixed[[col for col in SELL_COLUMNS if col in df_latest_prefixed.columns]]
-
-        # Merge bought row + latest row side by side
-        df_combined = pd.concat([df_bought_filtered.reset_index(drop=True),
-                                 df_latest_filtered.reset_index(drop=True)], axis=1)
-
-        # -------------------------- Run Sell model --------------------------
-        result = sell_model_run({"data": df_combined, "model_file": model_file})
-        if result.get("status") != "success":
-            logging.error(f"Sell model prediction failed for {symbol}: {result.get('message')}")
-            continue
-
-        df_suggested = result.get("suggested_trades")
-        if df_suggested.empty:
-            logging.info(f"Sell model returned no suggested trades for {symbol}.")
-            continue
-
-        # -------------------------- Postprocess predictions --------------------------
-        df_suggested["trade_type"] = "SELL"
-        df_suggested["buyid"] = buyid_obj  # store as ObjectId
-        df_suggested["sellid"] = sellid
-
-        # Ensure confidence score exists
-        if "confidence_score" not in df_suggested.columns or df_suggested["confidence_score"].isnull().all():
-            logging.warning(f"No confidence_score returned for {symbol}. Skipping save.")
-            continue
-
-        # Rename confidence_score → sell_score
-        df_suggested.rename(columns={"confidence_score": "sell_score"}, inplace=True)
-
-        # Filter by minimum sell_score
-        df_suggested = df_suggested[df_suggested["sell_score"] >= MIN_SELL_SCORE]
-        if df_suggested.empty:
-            logging.info(f"No sell predictions above threshold for {symbol}. Skipping save.")
-            continue
-
-        # Ensure symbol exists
-        if "symbol" not in df_suggested.columns:
-            df_suggested["symbol"] = symbol
-
-        # Columns to save
-        columns_to_save = ["symbol", "trade_type", "sell_score", "buyid", "sellid"]
-        df_to_save = df_suggested[[c for c in columns_to_save if c in df_suggested.columns]]
-
-        # -------------------------- Save to suggested_trades collection with created_at --------------------------
-        try:
-            for record in df_to_save.to_dict("records"):
-                now = datetime.utcnow()
-                suggested_trades_col.update_one(
-                    {"symbol": record["symbol"], "trade_type": record["trade_type"]},
-                    {"$set": {**record, "created_at": now}},  # overwrite created_at every run
-                    upsert=True
-                )
-            logging.info(f"Saved {len(df_to_save)} sell predictions for {symbol} (upserted) to {suggested_trades_collection_name}")
-        except Exception as e:
-            logging.error(f"Error saving suggested trades for {symbol}: {e}")
+    # -------------------------- Save to suggested_trades collection with created_at --------------------------
+    run_ts = datetime.now(timezone.utc)  # one instant for the whole run
+
+    # One upsert per (symbol, SELL) key: the unordered batch applies writes in any order,
+    # so keep only the last trade per symbol (the one that won in cursor order before)
+    last_by_symbol = {symbols[i]: i for i in keep}
+
+    ops = [
+        UpdateOne(
+            {"symbol": symbols[i], "trade_type": "SELL"},
+            {"$set": {
+                "symbol": symbols[i],
+                "trade_type": "SELL",
+                "sell_score": float(scores[i]),
+                "buyid": buyids[i],
+                "sellid": sellids[i],
+                "created_at": run_ts,  # overwrite created_at every run
+            }},
+            upsert=True
+        )
+        for i in last_by_symbol.values()
+    ]
+    try:
+        suggested_trades_col.bulk_write(ops, ordered=False)
+        logging.info(f"Saved {len(ops)} sell predictions (upserted) to {SUGGESTED_TRADES_COLLECTION}")
+    except Exception as e:
+        logging.error(f"Error saving suggested trades: {e}")
 
     logging.info("Stage 2 Sell orchestrator completed successfully.")
 
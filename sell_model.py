@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import xgboost as xgb
 import logging
@@ -5,6 +6,57 @@ import os
 
 logging.basicConfig(level=logging.INFO)
 
+# Original bought columns
+BOUGHT_COLUMNS = [
+    "open", "high", "low", "close", "volume",
+    "macd", "macd_signal", "macd_histogram",
+    "rsi", "rsi_sma",
+    "ema_100", "ema_200",
+    "atr", "ema_ratio",
+    "macd_histogram_x_atr", "buy_sell_pressure_x_ema_ratio",
+    "buy_sell_pressure", "relative_volume",
+    "quote_volume_ratio", "rsi_x_relative_volume"
+]
+
+# Add prefixes for model feature list
+BUY_COLUMNS = [f"buy_{col}" for col in BOUGHT_COLUMNS]   # bought asset features
+SELL_COLUMNS = [f"sell_{col}" for col in BOUGHT_COLUMNS] # latest/current features
+
+# Combine both for expected features (order matches the trained model)
+EXPECTED_FEATURES = BUY_COLUMNS + SELL_COLUMNS
+
+# Raw bought column -> 'buy_' feature name
+BUY_RENAME = dict(zip(BOUGHT_COLUMNS, BUY_COLUMNS))
+
+# Loaded Boosters keyed by model file path, so the model is parsed once per process
+_MODEL_CACHE = {}
+
+def load_model(model_file):
+    """
+    Return the Sell XGBoost Booster for model_file, loading it from disk on first use.
+    """
+    model = _MODEL_CACHE.get(model_file)
+    if model is None:
+        model = xgb.Booster()
+        model.load_model(model_file)
+        model.set_param({"nthread": os.cpu_count()})
+        _MODEL_CACHE[model_file] = model
+        logging.info(f"Loaded Sell XGBoost model from {model_file}")
+    return model
+
+def predict_scores(X32, model):
+    """
+    Score a batch of trades with the Sell model.
+
+    X32: float32 array of shape (n_trades, len(EXPECTED_FEATURES)), columns in
+         EXPECTED_FEATURES order (buy_ features, then sell_ features); NaN = missing
+    model: Booster from load_model
+    Returns a 1-D array of sell scores, one per row.
+    """
+    features = np.ascontiguousarray(X32, dtype=np.float32)
+    dmatrix = xgb.DMatrix(features, feature_names=EXPECTED_FEATURES, nthread=-1)
+    return model.predict(dmatrix)
+
 def run(inputs):
     """
     Run Sell model prediction with buy_ and sell_ feature prefixes.
@@ -27,60 +79,31 @@ def run(inputs):
         logging.error(f"Sell model file not found: {model_file}")
         return {"status": "error", "message": "model_file missing"}
 
-    # Load the Sell XGBoost model
+    # Load the Sell XGBoost model (cached after the first call)
     try:
-        model = xgb.Booster()
-        model.load_model(model_file)
-        logging.info(f"Loaded Sell XGBoost model from {model_file}")
+        model = load_model(model_file)
     except Exception as e:
         logging.error(f"Error loading Sell model: {e}")
         return {"status": "error", "message": "Failed to load model"}
 
-    # Original bought columns
-    BOUGHT_COLUMNS = [
-        "open", "high", "low", "close", "volume",
-        "macd", "macd_signal", "macd_histogram",
-        "rsi", "rsi_sma",
-        "ema_100", "ema_200",
-        "atr", "ema_ratio",
-        "macd_histogram_x_atr", "buy_sell_pressure_x_ema_ratio",
-        "buy_sell_pressure", "relative_volume",
-        "quote_volume_ratio", "rsi_x_relative_volume"
-    ]
-
-    # Add 'buy_' prefix to DataFrame columns if not already present
-    for col in BOUGHT_COLUMNS:
-        if col in df.columns:
-            df[f"buy_{col}"] = df[col]
-
-    # Add prefixes for model feature list
-    BUY_COLUMNS = [f"buy_{col}" for col in BOUGHT_COLUMNS]   # bought asset features
-    SELL_COLUMNS = [f"sell_{col}" for col in BOUGHT_COLUMNS] # latest/current features
-
-    # Combine both for expected features
-    EXPECTED_FEATURES = BUY_COLUMNS + SELL_COLUMNS
-
-    # Filter df to only available columns
-    available_features = [col for col in EXPECTED_FEATURES if col in df.columns]
-
-    # Log missing features
-    missing = set(EXPECTED_FEATURES) - set(df.columns)
+    # Model features under their 'buy_'/'sell_' names; df itself keeps the original columns
+    df_features = df.rename(columns=BUY_RENAME)
+
+    # Missing features would be scored as NaN, so refuse to predict
+    missing = set(EXPECTED_FEATURES) - set(df_features.columns)
     if missing:
         logging.warning(f"Missing expected columns: {missing}")
+        return {"status": "error", "message": "Missing expected columns"}
 
     # Run predictions
     try:
-        dmatrix = xgb.DMatrix(df[available_features])
-        df["confidence_score"] = model.predict(dmatrix)
+        features = df_features[EXPECTED_FEATURES].to_numpy(dtype=np.float32)
+        df = df.assign(confidence_score=predict_scores(features, model))
         logging.info(f"Predictions generated for {len(df)} symbols")
     except Exception as e:
         logging.error(f"Error during prediction: {e}")
         return {"status": "error", "message": "Prediction failed"}
 
-    # Include sell_close from latest features if present
-    if "sell_close" in df.columns:
-        df["sell_close"] = df["sell_close"]
-
     # Columns to return
     columns_to_return = ["symbol", "timestamp", "confidence_score", "open", "high", "low", "volume"]
     if "sell_close" in df.columns: